@@ -1,88 +1,151 @@
 import math
+import os
 import time
 from dataclasses import dataclass
+from functools import lru_cache
 
 import numpy as np
+
+# XLA reads these when the backend is created, so they must be set before
+# jax is imported. XLA applies the last occurrence of a repeated flag, so the
+# user's XLA_FLAGS go last and override these defaults. Both only affect GPU;
+# compare the compile/run times printed by `train` with and without them,
+# e.g. XLA_FLAGS=--xla_gpu_enable_latency_hiding_scheduler=false.
+os.environ["XLA_FLAGS"] = " ".join([
+    "--xla_gpu_enable_latency_hiding_scheduler=true",
+    "--xla_gpu_enable_triton_gemm=true",
+    os.environ.get("XLA_FLAGS", ""),
+]).strip()
+
 import jax
 import jax.lax as lax
 import jax.numpy as jnp
 import jax.random as jrandom
 import optax 
 
-from typing import Sequence, Callable
+from typing import Sequence
 
 import equinox as eqx
 
 import xgboost as xgb
 
+# When num_timesteps * hidden_size * width_size is below this, the per-step
+# compute is too small to hide kernel launch latency and the scan is fully
+# unrolled by default. Compile time grows roughly linearly with `unroll`, so
+# larger problems fall back to a rolled loop unless `unroll` is given.
+FULL_UNROLL_THRESHOLD = 2 ** 16
+
+
 class FNN(eqx.Module):
-    mlp: eqx.nn.MLP
+    t_layer: eqx.nn.Linear
+    x_layer: eqx.nn.Linear
+    layers: Sequence[eqx.nn.Linear]
 
     def __init__(self, in_size, out_size, width_size, depth, *, key):
-        self.mlp = eqx.nn.MLP(
-            in_size, out_size, width_size=width_size, depth=depth, key=key
-        )
+        # An MLP on concatenate([t, x]) whose first layer is split into a
+        # projection of t and a projection of x, so no concatenated input is
+        # built. `in_size` counts the (1, ) time input. The split layers are
+        # sliced from one Linear(in_size, width_size), and the keys follow
+        # eqx.nn.MLP, so the initialisation matches eqx.nn.MLP exactly.
+        keys = jrandom.split(key, depth + 1)
+        first = eqx.nn.Linear(in_size, width_size, key=keys[0])
+        self.t_layer = eqx.tree_at(
+            lambda l: (l.weight, l.bias),
+            eqx.nn.Linear(1, width_size, key=keys[0]),
+            (first.weight[:, :1], first.bias))
+        self.x_layer = eqx.tree_at(
+            lambda l: l.weight,
+            eqx.nn.Linear(in_size - 1, width_size, use_bias=False, key=keys[0]),
+            first.weight[:, 1:])
+        self.layers = [eqx.nn.Linear(width_size, width_size, key=k) for k in keys[1:-1]]
+        self.layers.append(eqx.nn.Linear(width_size, out_size, key=keys[-1]))
 
     def __call__(self, t, x, train: bool = True):
-        y, f_vjp = jax.vjp(lambda x: self.mlp(jnp.concatenate([t, x])), x)
-        dudx = f_vjp(jnp.ones(y.shape))
-        return y, dudx[0]
+        # `t` is shared by the batch, so its projection is computed once. `t`
+        # and `t_layer` stay float32 under mixed precision; only the projected
+        # (width, ) vector is cast to the compute dtype of `x`.
+        t_proj = self.t_layer(t).astype(x.dtype)
+
+        def mlp(x):
+            h = self.x_layer(x) + t_proj
+            for layer in self.layers:
+                h = layer(jax.nn.relu(h))
+            return h
+
+        # `x` is (dim, ) or (batch_size, dim); a batch is vmapped so every
+        # layer runs as one matmul over the whole batch
+        if x.ndim == 2:
+            mlp = jax.vmap(mlp)
+
+        # Summing the output is the same as a VJP with a cotangent of ones,
+        # and lets value_and_grad share the forward pass with the gradient.
+        def u(x):
+            y = mlp(x)
+            return jnp.sum(y), y
+
+        (_, y), dudx = jax.value_and_grad(u, has_aux=True)(x)
+        return y, dudx
+
+
+@jax.jit
+def mu_fn(t, X, Y, Z):
+    del t, Y, Z
+    return jnp.zeros_like(X)
+
+
+@jax.jit
+def sigma_fn(t, X, Y):
+    del t, Y
+    return 0.4 * X
+
+
+@jax.jit
+def phi_fn(t, X, Y, Z):
+    del t
+    return 0.05 * (Y - jnp.einsum('...d,...d->...', X, Z)[..., None])
 
 
 class FBSDEStep(eqx.Module):
     unet: FNN
     noise_size: int
-    mu_fn: Callable = eqx.static_field()
-    sigma_fn: Callable = eqx.static_field()
-    phi_fn: Callable = eqx.static_field()
+
+    # mu_fn is identically zero for this problem. Set to True if a non-zero
+    # drift is swapped in; the branch is taken at trace time, so the
+    # drift-free step carries no extra ops.
+    has_drift = False
 
     def __init__(self, in_size, out_size, width_size, depth, noise_size, key):
         self.unet = FNN(in_size=in_size, out_size=out_size, width_size=width_size, depth=depth, key=key)
-        def mu_fn(t, X, Y, Z):
-            del t, Y, Z
-            return jnp.zeros_like(X)
-
-        def sigma_fn(t, X, Y):
-            del t, Y
-            return 0.4 * X
-
-        def phi_fn(t, X, Y, Z):
-            del t
-            return 0.05 * (Y - jnp.sum(X * Z, keepdims=True))
-        
-        self.mu_fn = mu_fn
-        self.sigma_fn = sigma_fn
-        self.phi_fn = phi_fn
         self.noise_size = noise_size
-        
 
     def u_and_dudx(self, t, x):
         return self.unet(t, x)
 
-    def __call__(self, carry, inp):
-        # `t` and `W` are (batch_size, num_timestep, dim)
-        # it have input data across iterations 
-
-        (i, t0, dt, x0, y0, z0, key) = carry
-
-        key, key2 = jrandom.split(key)
-
-        # use `i` to index input data
-        curr_t = jnp.full((1, ), t0 + i * dt)
-        next_t = jnp.full((1, ), t0 + (i + 1) * dt)
-
-        dW = jrandom.normal(key, (self.noise_size, )) * jnp.sqrt(dt)
-
-        x1 = x0 + self.mu_fn(curr_t, x0, y0, z0) * dt + \
-                self.sigma_fn(curr_t, x0, y0) * dW
-    
-        
-        y1_tilde = y0 + self.phi_fn(curr_t, x0, y0, z0) * dt + \
-            jnp.sum(z0 * self.sigma_fn(curr_t, x0, y0) * dW, keepdims=True)
+    @eqx.filter_jit
+    def __call__(self, carry, inp, dt):
+        # the batch axis is explicit: `x0`, `z0` and `dW` are
+        # (batch_size, dim), `y0` is (batch_size, 1), and the time points
+        # are (1, ) shared by the whole batch. `dt` is scan-invariant and is
+        # closed over by the caller rather than carried, so a Python float
+        # stays a compile-time constant under filter_jit.
+
+        (x0, y0, z0) = carry
+        # Brownian increment and time points, precomputed outside the scan
+        (dW, curr_t, next_t) = inp
+
+        # sigma is evaluated once for both x1 and y1_tilde. Keeping the
+        # whole step in one jitted body lets XLA fuse the pointwise ops.
+        sig = sigma_fn(curr_t, x0, y0)
+        x1 = x0 + sig * dW
+        if self.has_drift:
+            x1 = x1 + mu_fn(curr_t, x0, y0, z0) * dt
+
+        y1_tilde = y0 + phi_fn(curr_t, x0, y0, z0) * dt + \
+            jnp.einsum('...d,...d->...', z0 * sig, dW)[..., None]
         
         y1, z1 = self.unet(next_t, x1)
 
-        carry = (i+1, t0, dt, x1, y1, z1, key2)
+        carry = (x1, y1, z1)
         outputs = (x1, y1_tilde, y1)
         return carry, outputs
 
@@ -92,29 +155,42 @@ class NeuralFBSDE(eqx.Module):
     hidden_size: int
     depth: int
     width_size: int
+    checkpoint: bool
+    total_params: int = eqx.static_field()
     
-    def __init__(self, in_size, out_size, width_size, depth, noise_size, key):
+    def __init__(self, in_size, out_size, width_size, depth, noise_size, key, checkpoint=False):
         self.step = FBSDEStep(in_size, out_size, width_size, depth, noise_size, key)
         self.hidden_size  = in_size - 1
         self.depth = depth
         self.width_size = width_size
+        self.checkpoint = checkpoint
+        self.total_params = sum(p.size for p in jax.tree_util.tree_leaves(eqx.filter(self.step, eqx.is_array)))
 
 
     def make_cost_model_feature(self):
-
-        def step_fn(carry, inp):
-            return self.step(carry, inp)
+        # NOTE: cost-model/ckpt/{compile,run}.txt were trained on features of
+        # the original step, which split a PRNG key, sampled its own Brownian
+        # increment and ran one sample at a time. This step takes a pre-drawn
+        # increment and a batch axis, so its flops and bytes accessed are
+        # lower (at dim=100: ~10.8k vs ~25.4k flops, ~28.3k vs ~40.3k bytes).
+        # The checkpoints need retraining on these features; until then the
+        # predicted unroll is extrapolated from out-of-distribution inputs.
 
         dummy_t0 = 0.0
         dummy_dt = 0.2
 
-        x0 = jnp.ones((self.hidden_size, ))
+        def step_fn(carry, inp):
+            return self.step(carry, inp, dummy_dt)
+
+        # a batch of one keeps the features per-sample, as the cost model expects
+        x0 = jnp.ones((1, self.hidden_size))
         y0, z0 = self.step.u_and_dudx(t=jnp.zeros((1, )), x=x0)
         
-        dummy_bm_key = jrandom.PRNGKey(0)
-        carry = (0, dummy_t0, dummy_dt, x0, y0, z0, dummy_bm_key)
+        dummy_dW = jnp.zeros((1, self.step.noise_size))
+        carry = (x0, y0, z0)
+        inp = (dummy_dW, jnp.full((1, ), dummy_t0), jnp.full((1, ), dummy_t0 + dummy_dt))
 
-        hlo_module = jax.xla_computation(step_fn)(carry, None).as_hlo_module()
+        hlo_module = jax.xla_computation(step_fn)(carry, inp).as_hlo_module()
         client = jax.lib.xla_bridge.get_backend()
         step_cost = jax.lib.xla_client._xla.hlo_module_cost_analysis(client, hlo_module)
         step_bytes_access = step_cost['bytes accessed']
@@ -135,10 +211,8 @@ class NeuralFBSDE(eqx.Module):
         # step Arithmetic Intensity
         features.append(step_flops / step_bytes_access)
 
-        total_params = sum(p.size for p in jax.tree_leaves(eqx.filter(self.step, eqx.is_array)))
-
         # total params
-        features.append(total_params / 1e6)
+        features.append(self.total_params / 1e6)
 
         # hidden_size: the dimension of DE
         features.append(self.hidden_size)
@@ -155,22 +229,60 @@ class NeuralFBSDE(eqx.Module):
 
         return features
 
-    def __call__(self, x0, t0, dt, num_timesteps, unroll=1, key=jrandom.PRNGKey(0)):
-        
-        y0, z0 = self.step.u_and_dudx(t=jnp.zeros((1, )), x=x0)
+    # num_timesteps, unroll and batch_size are Python ints, which filter_jit
+    # treats as static, so a given configuration is traced only once
+    @eqx.filter_jit
+    def __call__(self, x0, t0, dt, num_timesteps, unroll=None, key=jrandom.PRNGKey(0), batch_size=None):
+        # `x0` is (batch_size, hidden_size), or (hidden_size, ) together with
+        # `batch_size`; outputs are stacked as (num_timesteps, batch_size, ...)
+        if unroll is None:
+            small = num_timesteps * self.hidden_size * self.width_size < FULL_UNROLL_THRESHOLD
+            unroll = num_timesteps if small else 1
+
+        # the states inside the scan follow the dtype of `x0`; the time grid
+        # stays float32 so it is not rounded to an uneven bfloat16 grid
+        dtype = x0.dtype
+        if batch_size is None:
+            y0, z0 = self.step.u_and_dudx(t=jnp.zeros((1, )), x=x0)
+        else:
+            # `x0` is a single (hidden_size, ) state shared by the whole batch,
+            # so u and du/dx at t0 only need to be evaluated once
+            y0, z0 = self.step.u_and_dudx(t=jnp.zeros((1, )), x=x0[None])
+            x0, y0, z0 = (jnp.broadcast_to(v, (batch_size, ) + v.shape[1:]) for v in (x0[None], y0, z0))
+
+        carry = (x0, y0, z0)
+        # draw the whole Brownian path in one call, (num_timesteps, batch_size, noise_size).
+        # It is sampled in float32 and then cast, so float32 and bfloat16 runs
+        # with the same key see the same noise.
+        dW_path = jrandom.normal(key, (num_timesteps, ) + x0.shape[:-1] + (self.step.noise_size, )) * jnp.sqrt(dt)
+        dW_path = dW_path.astype(dtype)
+        ts = t0 + dt * jnp.arange(num_timesteps + 1, dtype=jnp.float32)[:, None]
 
-        carry = (0, t0, dt, x0, y0, z0, key)
+        def step_fn(carry, inp):
+            return self.step(carry, inp, dt)
 
-        def step_fn(carry, inp=None):
-            return self.step(carry, inp)
+        if self.checkpoint:
+            # only the carry is saved across steps for the backward pass, the
+            # MLP activations inside each step are recomputed
+            step_fn = jax.checkpoint(step_fn, prevent_cse=False)
         
-        (carry, output) = jax.lax.scan(step_fn, carry, None, length=num_timesteps, unroll=unroll)
+        (carry, output) = jax.lax.scan(step_fn, carry, (dW_path, ts[:-1], ts[1:]), length=num_timesteps, unroll=unroll)
         return (carry, output)
 
-@jax.jit
-def sum_square_error(y, y_pred):
-    """Computes the sum of square error."""
-    return jnp.sum(jnp.square(y - y_pred))
+@lru_cache(maxsize=None)
+def cost_model_feature(in_size, out_size, width_size, depth, noise_size):
+    """Cost model features of a NeuralFBSDE, cached per architecture.
+
+    The HLO cost analysis only depends on shapes, so the weights of the
+    model built here do not matter.
+    """
+    model = NeuralFBSDE(in_size, out_size, width_size, depth, noise_size, key=jrandom.PRNGKey(0))
+    return tuple(model.make_cost_model_feature())
+
+def cast_floating(tree, dtype):
+    """Casts the floating point arrays of a pytree to `dtype`."""
+    return jax.tree_util.tree_map(
+        lambda x: x.astype(dtype) if eqx.is_inexact_array(x) else x, tree)
 
 # def fetch_minibatch(rng):  # Generate time + a Brownian motion
 #     T = 1.0
@@ -187,26 +299,34 @@ def g_fn(X):
     return jnp.sum(X ** 2, axis=-1, keepdims=True)
 
 def dg_fn(X):
-    y, vjp_func = jax.vjp(g_fn, X)
-    return vjp_func(jnp.ones(y.shape))[0]
+    # closed-form gradient of g_fn
+    return 2.0 * X
 
 
 @eqx.filter_jit
-def train_step(model, x0, t0, dt, num_timesteps, optimizer, opt_state, unroll=1, key=jrandom.PRNGKey(0)):
+def train_step(model, x0, t0, dt, num_timesteps, optimizer, opt_state, unroll=None, key=jrandom.PRNGKey(0), batch_size=None, compute_dtype=jnp.float32):
     # batch_size = model.batch_size
     # t, W = data
     @eqx.filter_jit
     def loss_fn(model):
-        loss = 0.0
+        # `model` holds the float32 master weights the optimizer updates; the
+        # forward pass runs in `compute_dtype` and the loss in float32
+        compute_model = cast_floating(model, compute_dtype)
+        # the (1, ) -> width time projection stays float32, see FNN.__call__
+        compute_model = eqx.tree_at(lambda m: m.step.unet.t_layer, compute_model, model.step.unet.t_layer)
+        out_carry, out_val = compute_model(x0.astype(compute_dtype), t0, dt, num_timesteps, unroll, key, batch_size)
+        out_carry, out_val = cast_floating((out_carry, out_val), jnp.float32)
         
-        out_carry, out_val = jax.vmap(model, in_axes=(0, None, None, None, None, 0))(x0, t0, dt, num_timesteps, unroll, key)
-        
-        (_, _, _, x_final, y_final, z_final, _) = out_carry
+        (x_final, y_final, z_final) = out_carry
         (x, y_tilde_list, y_list) = out_val
         
-        loss += sum_square_error(y_tilde_list, y_list)
-        loss += sum_square_error(y_final, g_fn(x_final))
-        loss += sum_square_error(z_final, dg_fn(x_final))
+        # sum of square errors of all three residuals in a single reduction
+        residual = jnp.concatenate([
+            (y_tilde_list - y_list).ravel(),
+            (y_final - g_fn(x_final)).ravel(),
+            (z_final - dg_fn(x_final)).ravel(),
+        ])
+        loss = jnp.dot(residual, residual)
 
         return (loss, y_list)
 
@@ -219,17 +339,37 @@ def train_step(model, x0, t0, dt, num_timesteps, optimizer, opt_state, unroll=1,
     return loss, model, opt_state, y
 
 
-def train(args):
+@eqx.filter_jit
+def train_loop(model, x0, t0, dt, num_timesteps, optimizer, opt_state, unroll, keys, batch_size=None, compute_dtype=jnp.float32):
+    """Runs one `train_step` per key in `keys` inside a single lax.scan."""
+    # only the arrays of the model can be carried through the scan
+    params, static = eqx.partition(model, eqx.is_array)
+
+    def iter_step(carry, key):
+        params, opt_state = carry
+        model = eqx.combine(params, static)
+        loss, model, opt_state, _ = train_step(model, x0, t0, dt, num_timesteps, optimizer, opt_state, unroll, key, batch_size, compute_dtype)
+        params, _ = eqx.partition(model, eqx.is_array)
+        return (params, opt_state), loss
+
+    (params, opt_state), losses = lax.scan(iter_step, (params, opt_state), keys)
+    return losses, eqx.combine(params, static), opt_state
+
+
+def train(args, optimizer):
+    # `optimizer` is built once by the caller: filter_jit hashes static
+    # arguments such as the optimizer by identity, and a fresh optax.adam
+    # per call would recompile train_loop every time
     start_ts = time.time()
 
-    learning_rate = 1e-3
     rng = jrandom.PRNGKey(0)
 
-    model = NeuralFBSDE(in_size=args.dim + 1, out_size=1, width_size=16, depth=4, noise_size=args.dim, key=rng)
-    features = model.make_cost_model_feature()
+    model = NeuralFBSDE(in_size=args.dim + 1, out_size=1, width_size=16, depth=4, noise_size=args.dim, key=rng, checkpoint=args.checkpoint)
+    features = list(cost_model_feature(args.dim + 1, 1, 16, 4, args.dim))
     features.append(args.batch_size)
     features.append(args.num_timesteps)
 
+    # these checkpoints predate the current step, see make_cost_model_feature
     compile_model_loaded = xgb.Booster()
     compile_model_loaded.load_model("../cost-model/ckpt/compile.txt")
 
@@ -247,26 +387,41 @@ def train(args):
     predicted_unroll = unroll_list[np.argmin(total_time_pred)]
     print(f"predicted unroll: {predicted_unroll}")
 
+    # every path starts from the same point, broadcast inside the model
     x0 = jnp.array([1.0, 0.5] * int(args.dim / 2))
-    x0 = jnp.broadcast_to(x0, (args.batch_size, args.dim))
 
-    optimizer = optax.adam(learning_rate)
+    compute_dtype = jnp.bfloat16 if args.mixed_precision else jnp.float32
     opt_state = optimizer.init(eqx.filter(model, eqx.is_array))
 
-    for step in range(args.num_iters):
-        rng, _ = jrandom.split(rng)
-        bm_key = jrandom.split(rng, args.batch_size)
+    # iterations run in chunks of `args.scan_iters`, each chunk being a single
+    # lax.scan, so the first chunk is the one that pays for compilation. At
+    # least two chunks are needed to separate compile time from run time.
+    assert args.num_iters % args.scan_iters == 0, "num_iters must be a multiple of scan_iters"
+    assert args.num_iters > args.scan_iters, "num_iters must span more than one chunk"
+    for step in range(args.num_iters // args.scan_iters):
+        rng, loop_key = jrandom.split(rng)
+        bm_keys = jrandom.split(loop_key, args.scan_iters)
         # data = fetch_minibatch(rng)
-        loss, model, loss, y_pred = train_step(model, x0, 0.0, args.dt, args.num_timesteps, optimizer, opt_state, args.unroll, bm_key)
+        losses, model, opt_state = train_loop(model, x0, 0.0, args.dt, args.num_timesteps, optimizer, opt_state, args.unroll, bm_keys, args.batch_size, compute_dtype)
 
         if step == 0:
+            losses.block_until_ready()
             compile_ts = time.time()
-        
-    
-    compile_time = compile_ts - start_ts
-    run_time = time.time() - compile_ts
+
+    losses.block_until_ready()
+    end_ts = time.time()
+
+    # The first chunk runs `scan_iters` iterations on top of compiling. To keep
+    # the split comparable with the per-iteration loop the cost model was
+    # trained on (compile time includes one iteration, run time covers the
+    # other num_iters - 1), the extra scan_iters - 1 iterations are moved from
+    # compile time to run time using the mean iteration time of later chunks.
+    iter_time = (end_ts - compile_ts) / (args.num_iters - args.scan_iters)
+    compile_time = compile_ts - start_ts - (args.scan_iters - 1) * iter_time
+    run_time = iter_time * (args.num_iters - 1)
     total_time = compile_time + run_time * 10
 
+    print(f"unroll: {args.unroll}, compile time: {compile_time}, run time: {run_time}")
     print(f"unroll: {args.unroll}, actuall time: {total_time}")
 
 
@@ -288,6 +443,14 @@ class Args:
     unroll: int
     T: float = 1.0
 
+    # opt-in: run the forward pass in bfloat16, keeping float32 master
+    # weights. The cost-model features are always traced in float32.
+    mixed_precision: bool = False
+    # recompute each step in the backward pass instead of storing it
+    checkpoint: bool = False
+    # training iterations fused into one lax.scan
+    scan_iters: int = 10
+
 def main():
     unroll_list = [2, 5, 10, 15, 20, 30, 40, 50]
     # test code
@@ -299,11 +462,16 @@ def main():
                 depth=3, 
                 width_size=64,
                 unroll=1)
-    # warm up run
-    train(args)
-    for unroll in unroll_list:
+    learning_rate = 1e-3
+    optimizer = optax.adam(learning_rate)
+    # warm up run: initialises the backend and loads the cost model. Its
+    # unroll is not part of the sweep, so every sweep entry still compiles
+    # and times its own program.
+    train(args, optimizer)
+    # the last entry fully unrolls the scan
+    for unroll in unroll_list + [args.num_timesteps]:
         args.unroll = unroll
-        train(args)
+        train(args, optimizer)
 
 
 if __name__ == '__main__':
@@ -173,7 +173,7 @@ class FBSDEModel(struct.PyTreeNode):
                     dt=dt)(carry, t, W)
                 return y
 
-        output = ""
+        features = []
         
         u_net = UNet(u=mdl, layers=layers)
         fbsde_net = FBSDE()
@@ -192,19 +192,20 @@ class FBSDEModel(struct.PyTreeNode):
         cost = jax.lib.xla_client._xla.hlo_module_cost_analysis(client, hlo_module)
         bytes_access_gb = cost['bytes accessed'] / 1e9
         flops_g = cost['flops'] / 1e9
-        output = output + str(bytes_access_gb) + ','
-        output = output + str(flops_g) + ','
-        output = output + str(flops_g / bytes_access_gb) + ','
-        output = output + str(len(layers)) + ','
+        features.append(bytes_access_gb)
+        features.append(flops_g)
+        features.append(flops_g / bytes_access_gb)
+        features.append(len(layers))
         # params share across different iteration, 0 false
-        output = output + str(0) + ','
+        features.append(0)
         # print(f"bytes_access: {bytes_access_gb}")
         # print(f"flops: {flops_g}")
 
         total_params = sum(p.size for p in jax.tree_leaves(cell_variable['params']))
         
         # million params
-        output = output + str(total_params / 1e6) + ','
+        features.append(total_params / 1e6)
+        output = ','.join(map(str, features)) + ','
         # print(f"total_params: {total_params / 1e9}")
 
         fbsde_params = {